@@ -1,36 +1,54 @@
 #!/usr/bin/env python
-from enum import Enum
+from enum import IntEnum   # int comparisons and hashing are cheaper than plain Enum's on the per message path
 import paho.mqtt.client as mqtt  #import the client1
 from datetime import datetime
 import time
 
 import signal   #to detect CTRL C
 import sys
+import logging # debug output is only formatted when its level is enabled
 
 import json #to generate payloads for mqtt publishing
-import jsonpickle #json.dumps crashes for InstantMessage. jsonpickle works fine
 import random #for the disarm pin
+import hmac # constant time comparison of the disarm pin
 import threading    #for timing the countdowns
 import os.path # to check if configuration file exists
 import re # regular expression to detect trigger events
+from collections import OrderedDict # insertion ordered cache of command topic matches
+try:    # to find the literal text a trigger regex requires
+    from re import _parser as sre_parse, _constants as sre_constants   # python 3.11+, where the sre_* modules are deprecated
+except ImportError:
+    import sre_parse, sre_constants
 import requests # for translation
+from requests.adapters import HTTPAdapter
 
 sys.path.append( os.path.abspath('../mqtt_notifier' ) )
 from aux import *
 from gsm import SMS
 
-from pprint import pprint #for debug printing
+from pprint import pformat #for logging the configuration
+
+logger = logging.getLogger( __name__ )
+
+clock = getattr( time, 'monotonic', time.time )  # python 2 has no monotonic clock, the countdowns then follow the wall clock
+
+try:
+    basestring
+except NameError:   # python 3
+    basestring = str
 
 class MqttParams( object ):
     """ Holds the mqtt connection params
     """
+    __slots__ = ( 'address', 'port', 'subscribeTopic', 'publishTopic' )
+
     def __init__( self, address, port, subscribeTopic, publishTopic ):
         self.address = address
         self.port = port
         self.subscribeTopic = subscribeTopic
         self.publishTopic = publishTopic
 
-class StatusMain( Enum ):
+class StatusMain( IntEnum ):
     """The possible status values for the alarm status main property
 
     Values:
@@ -49,6 +67,8 @@ class StatusMain( Enum ):
     TRIGGERED = 5
     ACTIVATED = 6
 
+STATUS_NAMES = { s: s.name for s in StatusMain }  # .name goes through the enum descriptor machinery, this is a dict lookup
+
 class Status( object ):
     """ The status of an alarm
 
@@ -57,19 +77,35 @@ class Status( object ):
         countdown: the countdown value when ARMING  or TRIGGERED
         challengePin: The disarm message must contain the correct pin answer i.e. (challengePin + disarmPin)%10
     """
+    __slots__ = ( 'main', 'countdown', 'challengePin', '__json' )
+
     def __init__( self, main = StatusMain.UNARMED, countdown = 0, challengePin = '' ):
+        if( challengePin and not challengePin.isdigit() ):
+            raise ValueError( 'challengePin must contain only digits, got "{}"'.format( challengePin ) )
         self.main = main
         self.countdown = countdown
         self.challengePin = challengePin
+        self.__json = None
 
     def toJson( self ):
-        """ Json strings must enclose tokens and string literals in double quotes
+        """ Json strings must enclose tokens and string literals in double quotes.
+            The fields are filled into a fixed template instead of going through json.dumps. This is safe because
+            the enum name and the digits only challengePin never need escaping.
+            The result is kept until tick changes the countdown, no other field is changed after construction
         """
-        return json.dumps( { 'main': self.main.name, 'countdown': self.countdown, 'challengePin': self.challengePin } )
+        if( self.__json is None ):
+            self.__json = '{"main": "%s", "countdown": %d, "challengePin": "%s"}' % ( STATUS_NAMES[ self.main ], self.countdown, self.challengePin )
+        return self.__json
+
+    def tick( self, countdown ):
+        """ Sets a new countdown in place, so that a countdown does not allocate a new Status every second
+        """
+        self.countdown = countdown
+        self.__json = None
 
     def __eq__( self, other ):
         if isinstance(other, self.__class__):
-            return self.__dict__ == other.__dict__
+            return self.main == other.main and self.countdown == other.countdown and self.challengePin == other.challengePin
         return False
 
     def __ne__( self, other ):
@@ -77,7 +113,7 @@ class Status( object ):
         """
         return not self.__eq__(other)
 
-class AlarmCommand( Enum ):
+class AlarmCommand( IntEnum ):
     """ The commands that the alarm accepts over mqtt
     """
     ARM_HOME = 1
@@ -88,53 +124,94 @@ class AlarmCommand( Enum ):
 
 
 class EmailConfig( object ):
+    __slots__ = ( 'sender', 'subject', 'recipients' )
+
     def __init__( self, sender, recipients, subject ):
         self.sender = sender
         self.subject = subject
         self.recipients = recipients
 
 class Notification( object ):
-    def __init__( self, notifierMqttPublish, messageTemplate, translationUrl ):
+    __slots__ = ( 'notifierMqttPublish', 'messageTemplate', 'translationUrl', 'translationCacheTtl', 'translationCache', 'session' )
+
+    def __init__( self, notifierMqttPublish, messageTemplate, translationUrl, translationCacheTtl = 3600 ):
         self.notifierMqttPublish = notifierMqttPublish
         self.messageTemplate = messageTemplate
         self.translationUrl = translationUrl
-
-    def generateMessage( self, mqttMessage ):
-        translation = None
+        self.translationCacheTtl = translationCacheTtl # seconds a topic translation is reused before it is fetched again
+        self.translationCache = {}  # topic -> ( fetch time, device name )
+        self.session = requests.Session()   # keeps the connection to the translation service open between requests
+        self.session.mount( 'http://', HTTPAdapter( pool_connections = 4, pool_maxsize = 4 ) )
+        self.session.mount( 'https://', HTTPAdapter( pool_connections = 4, pool_maxsize = 4 ) )
+
+    def translate( self, topic ):
+        """ Returns the device name house/floor/room/item that topic translates to. Translations are static so they are cached and
+            only fetched again after translationCacheTtl seconds. Failed fetches, error responses and translations missing
+            any of the four names raise and are not cached, so the next notification tries again
+        """
+        cached = self.translationCache.get( topic )
+        if( cached is not None and time.time() - cached[0] < self.translationCacheTtl ):
+            return cached[1]
+        response = self.session.get( self.translationUrl + topic )
+        response.raise_for_status()
+        translation = response.json()
+        deviceName = '/'.join( ( translation['house'], translation['floor'], translation['room'], translation['item'] ) )
+        self.translationCache[ topic ] = ( time.time(), deviceName )
+        return deviceName
+
+    def generateMessage( self, topic, text ):
+        """ Returns the message text as a unicode string. The template, the translation and the decoded payload
+            are all unicode already, so there is nothing to encode until json.dumps writes the notifier command
+        """
         message = self.messageTemplate
         try:
-            response = requests.get( self.translationUrl + mqttMessage.topic )
-            translation = response.json()
-            # print( 'received translation: ', json.dumps( translation, indent = 2 ).decode('utf-8') )
-            device_name = ( translation['house'] + '/' + translation['floor'] + '/' + translation['room'] + '/' + translation['item'] ).encode('utf-8')
-            # print( 'device_name: ', device_name.decode('utf-8') )
-            # print( 'messsage: ', message )
-            message = message.replace( '{device_name}', device_name.decode('utf-8') ).encode('utf-8')
-            # print( 'payload: {}'.format( mqttMessage.payload.decode( "utf-8" ) ) )
-            # print( 'now message: {}'.format( message ) )
-            message = message.decode('utf-8').replace( '{text}', mqttMessage.payload.decode( "utf-8" ) ).encode('utf-8')
+            message = message.replace( '{device_name}', self.translate( topic ) ).replace( '{text}', text )
         except Exception as e:
-            print( 'error: ', e.message, e.args )
-            pass
-        print( 'returning message: {}'.format( message ).decode('utf-8') )
+            logger.warning( 'could not translate topic %s for the notification message: %r', topic, e )
+        logger.debug( u'returning message: %s', message )
         return message
 
 
 class Notify( object ):
+    __slots__ = ( 'sms', 'phonecall', 'im', 'email' )
+
     def __init__( self, sms = [], phonecall = [], im = [], email = None ):
         self.sms = sms
         self.phonecall = phonecall
         self.im = im
         self.email = email
+
+    @staticmethod
+    def fromConfiguration( notifyConfiguration ):
+        """ Builds a Notify from the 'notify' object of a trigger in the configuration file. Returns None if there is none
+        """
+        if( notifyConfiguration is None ):
+            return None
+        email = notifyConfiguration.get( 'email' )
+        return Notify( 
+            notifyConfiguration.get( 'sms', [] ), 
+            notifyConfiguration.get( 'phonecall', [] ), 
+            notifyConfiguration.get( 'im', [] ), 
+            None if email is None else EmailConfig( email['from'], email['to'], email['subject'] )
+        )
     
     def toMqttCommand( self, messageText ):
-        print( 'messageText: {}, sms: {}, phonecall: {}, im: {}, email: {}'.format( messageText, self.sms, self.phonecall, self.im, self.email ) )
-        return jsonpickle.encode( { 
+        logger.debug( 'messageText: %s, sms: %s, phonecall: %s, im: %s, email: %s', messageText, self.sms, self.phonecall, self.im, self.email )
+        return json.dumps( { 
             'sms': SMS( self.sms, messageText  ), 
             'phonecall': self.phonecall, 
             'im': InstantMessage( self.im, messageText ),
             'email': None if self.email is None else Email( self.email.sender,  self.email.recipients, self.email.subject, messageText )
-        } )
+        }, default = Notify.toJsonable )
+
+    @staticmethod
+    def toJsonable( obj ):
+        """ json.dumps default for the SMS, InstantMessage and Email objects. They are written the way jsonpickle writes them,
+            i.e. their attributes plus a py/object tag, so the notifier can still decode the command with jsonpickle
+        """
+        jsonable = dict( vars( obj ) )
+        jsonable[ 'py/object' ] = obj.__class__.__module__ + '.' + obj.__class__.__name__
+        return jsonable
         
 
 class Trigger( object ):
@@ -144,20 +221,56 @@ class Trigger( object ):
     Attributes:
         topics: list of topics to subscibe and listen for incoming messages
         regex: a regeular expression to be matched against the payload of the received message. If matched the alarm triggers
+        pattern: the compiled regex, compiled once here instead of on every received message
+        keyword: literal text that every match of the regex contains, or None. Payloads without it cannot match
     """
+    __slots__ = ( 'topics', 'regex', 'pattern', 'keyword', 'notify' )
+
     def __init__( self, topics, regex, notify ):
         self.topics = topics
         self.regex = regex
+        self.pattern = re.compile( regex )
+        self.keyword = Trigger.requiredLiteral( self.pattern )
         self.notify = notify
 
+    def matches( self, text ):
+        """ True if the payload text fires this trigger. The substring test rejects most payloads before the regex engine runs
+        """
+        if( self.keyword is not None and self.keyword not in text ):
+            return False
+        return self.pattern.search( text ) is not None
+
+    @staticmethod
+    def requiredLiteral( pattern ):
+        """ Returns the longest run of literal characters at the top level of the compiled pattern, or None.
+            Top level literals are not inside a branch or a repeat so every match must contain them.
+            Case insensitive patterns are skipped because a plain substring test would be wrong for them
+        """
+        if( pattern.flags & re.IGNORECASE ):
+            return None
+        best = ''
+        run = ''
+        for op, av in sre_parse.parse( pattern.pattern, pattern.flags ):
+            if( op == sre_constants.LITERAL and av < 128 ):
+                run += chr( av )
+                if( len( run ) > len( best ) ):
+                    best = run
+            else:
+                run = ''
+        return best or None
+
 class MqttPublish( object ):
     """ This class holds the configuration for a publish command to be executed when starting or stopping an arm state """
+    __slots__ = ( 'topic', 'command' )
+
     def __init__( self, topic, command ):
          self.topic = topic
          self.command = command
 
 class ArmConfig( object ):
     """ This class holds the configuration for an arm state such as arm_home and arm_away, as it is loaded from configuration file """
+    __slots__ = ( 'start', 'stop', 'triggers' )
+
     def __init__( self, start, stop, triggers ):
         """ 
             start: the mqtt publish messages to send e.g. mqtt motion sensor activate
@@ -168,23 +281,113 @@ class ArmConfig( object ):
         self.stop = stop
         self.triggers = triggers
 
+    def triggerTopics( self ):
+        """ Returns the topics of all the triggers, each one once and in configuration order
+        """
+        topics = []
+        for t in self.triggers:
+            for o in t.topics:
+                if( o not in topics ):
+                    topics.append( o )
+        return topics
+
+    @staticmethod
+    def fromConfiguration( armConfiguration ):
+        """ Builds an ArmConfig from the 'armedAway' or 'armedHome' object of the configuration file
+        """
+        return ArmConfig( 
+            [ MqttPublish( x['topic'], x['command'] ) for x in armConfiguration['start'] ],
+            [ MqttPublish( x['topic'], x['command'] ) for x in armConfiguration['stop'] ],
+            [ Trigger( x['topics'], x['regex'], Notify.fromConfiguration( x.get( 'notify' ) ) ) for x in armConfiguration['triggers'] ]
+        )
+
+class TopicTrie( object ):
+    """ Mqtt topic filters stored level by level, so that finding the filters that match a topic is one walk
+        down the levels of the topic instead of a topic_matches_sub call per filter
+
+    Attributes:
+        children: topic level -> TopicTrie. The + and # wildcards are stored as levels like any other
+        values: the values inserted with a filter that ends at this node
+    """
+    __slots__ = ( 'children', 'values' )
+
+    def __init__( self ):
+        self.children = {}
+        self.values = []
+
+    def insert( self, topicFilter, value ):
+        node = self
+        for level in topicFilter.split( '/' ):
+            node = node.children.setdefault( level, TopicTrie() )
+        node.values.append( value )
+
+    def match( self, topic ):
+        """ Returns the values of all the filters that match topic, once per matching filter
+        """
+        matched = []
+        self.__match( topic.split( '/' ), 0, matched, topic.startswith( '$' ) )
+        return matched
+
+    def __match( self, levels, i, matched, system ):
+        """ system: the topic starts with $ and such topics are not matched by a wildcard in the first level
+        """
+        wildcards = not ( system and 0 == i )
+        multiLevel = self.children.get( '#' ) if wildcards else None
+        if( multiLevel is not None ):
+            #a/# matches a and everything below it
+            matched.extend( multiLevel.values )
+        if( len( levels ) == i ):
+            matched.extend( self.values )
+            return
+        child = self.children.get( levels[i] )
+        if( child is not None ):
+            child.__match( levels, i + 1, matched, system )
+        singleLevel = self.children.get( '+' ) if wildcards else None
+        if( singleLevel is not None ):
+            singleLevel.__match( levels, i + 1, matched, system )
+
 class MqttAlarm( object ):
     """ An alarm that publishes its status using mqtt and receives commands the same way
     """
+    ARMED_STATES = frozenset( [ StatusMain.ARMED_AWAY, StatusMain.ARMED_HOME ] )
+    TRIGGERED_STATES = frozenset( [ StatusMain.TRIGGERED, StatusMain.ACTIVATED ] )
+    WATCHING_STATES = ARMED_STATES | TRIGGERED_STATES  # states subscribed to trigger topics
+    DISARMABLE_STATES = ARMED_STATES | frozenset( [ StatusMain.ARMING ] )  # states a plain DISARM applies to
 
-    def __init__( self, armingCountdown, triggeredCountdown, disarmPin, mqttId, mqttParams, armedAway, armedHome, notification, status = Status( StatusMain.UNARMED, 0 ) ):
+    def __init__( self, armingCountdown, triggeredCountdown, disarmPin, mqttId, mqttParams, armedAway, armedHome, notification, status = Status( StatusMain.UNARMED, 0 ), countdownPublishInterval = 1 ):
         self.status = status
+        self.countdownPublishInterval = max( 0, countdownPublishInterval )  # publish every n-th second of a countdown, 0 for none
+        self.lastPublished = None   # json of the last published status, to skip publishing it again unchanged
         self.countdown = 0
         self.mqttParams = mqttParams
         self.armingCountdown = armingCountdown
         self.triggeredCountdown = triggeredCountdown
         self.mqttId = mqttId
         self.disarmPin = disarmPin
+        self.disarmPinDigits = [ int( d ) for d in disarmPin ]   # parsed once for computing the answer to each challenge
         self.sendPin = ''
+        self.modPin = ''    # the expected answer to sendPin, i.e. ( sendPin + disarmPin )%10 per digit
+        self.pinRandom = random.SystemRandom()  # os.urandom backed, the challenge pin must not be predictable
         self.armedAway = armedAway
         self.armedHome = armedHome
         self.notification = notification
         self.armStatus = None   # need to store this in case alarm status changes to TRIGGERED or ACTIVATED
+        self.armConfig = None   # the ArmConfig of armStatus, resolved once when arming
+        self.triggerTrie = TopicTrie()  # armed trigger topics -> ( position, trigger )
+        self.triggerPrefixes = ()   # the levels of the armed trigger topics before their first wildcard
+        self.commandTopics = OrderedDict()  # topic -> whether it matches subscribeTopic, oldest first
+        self.countdownStep = None   # ( step, args ) of the running ARMING or TRIGGERED countdown
+        self.countdownDue = 0       # clock() when countdownStep must be called next
+        self.countdownCondition = threading.Condition()   # guards the two above and wakes up the countdown thread
+        #a json payload names its command in "cmd", otherwise one pass over the payload finds the command as a whole word
+        self.commandRegex = re.compile( r'\b(' + '|'.join( sorted( [ c.name for c in AlarmCommand ], key = len, reverse = True ) ) + r')\b' )
+        self.commandHandlers = {
+            AlarmCommand.ARM_HOME.name: lambda payload: self.__arm( Status( StatusMain.ARMED_HOME ) ),
+            AlarmCommand.ARM_AWAY.name: lambda payload: self.__arm( Status( StatusMain.ARMED_AWAY ) ),
+            AlarmCommand.DEACTIVATE_REQUEST.name: lambda payload: self.__deactivateRequest(),
+            AlarmCommand.DEACTIVATE.name: self.__deactivate,
+            AlarmCommand.DISARM.name: lambda payload: self.__disarm()
+        }
 
         signal.signal( signal.SIGINT, self.__signalHandler )
         
@@ -195,221 +398,331 @@ class MqttAlarm( object ):
         self.client.on_message = self.__on_message
         #set last will and testament before connecting
         self.client.will_set( self.mqttParams.publishTopic, Status( StatusMain.UNAVAILABLE ).toJson(), qos = 1, retain = True )
-        self.client.connect( self.mqttParams.address, self.mqttParams.port )
-        self.client.loop_start()
-        #go in infinite loop
-        while( True ):
-            pass
+        #a single thread runs all the countdowns for the lifetime of the alarm
+        countdownThread = threading.Thread( target = self.__runCountdowns )
+        countdownThread.daemon = True
+        countdownThread.start()
+        #connect from inside the network loop, so a broker that is not up yet is retried instead of ending the alarm
+        self.client.connect_async( self.mqttParams.address, self.mqttParams.port )
+        #run the network loop in this thread, blocks until disconnect() is called
+        self.client.loop_forever( retry_first_connection = True )
 
     def __signalHandler( self, signal, frame ):
-        print('Ctrl+C pressed!')
+        logger.info( 'Ctrl+C pressed!' )
+        #makes loop_forever return
         self.client.disconnect()
-        self.client.loop_stop()
-        sys.exit(0)        
 
     def __on_connect( self, client, userdata, flags_dict, result ):
         """Executed when a connection with the mqtt broker has been established
         """
-        #debug:
-        m = "Connected flags"+str(flags_dict)+"result code " + str(result)+"client1_id  "+str(client)
-        print( m )
+        logger.info( 'Connected flags %s result code %s client1_id %s', flags_dict, result, client )
 
         #subscribe to start listening for incomming commands
         self.client.subscribe( self.mqttParams.subscribeTopic )
 
         #publish the initial status
+        self.lastPublished = None
         self.__setStatus( self.status )
 
     def __on_message( self, client, userdata, message ):
         """Executed when an mqtt arrives
         """
         text = message.payload.decode( "utf-8" )
-        print( 'Received message "{}"'.format( text ) )
-        if( mqtt.topic_matches_sub( self.mqttParams.subscribeTopic, message.topic ) ):
-            if( text.find( AlarmCommand.ARM_HOME.name ) > -1 ):
-                self.__arm( Status( StatusMain.ARMED_HOME ) )
-            elif( text.find( AlarmCommand.ARM_AWAY.name ) > -1 ):
-                self.__arm( Status( StatusMain.ARMED_AWAY ) )
-            elif( text.find( AlarmCommand.DEACTIVATE_REQUEST.name ) > -1 ):
-                self.__deactivateRequest()
-            elif( text.find( AlarmCommand.DEACTIVATE.name ) > -1 ):
-                self.__deactivate( text )
-            elif( text.find( AlarmCommand.DISARM.name ) > -1 ):
-                self.__disarm()
+        logger.debug( 'Received message "%s"', text )
+        if( self.__isCommandTopic( message.topic ) ):
+            payload = self.__parsePayload( text )
+            handler = self.__commandHandler( text, payload )
+            if( handler is not None ):
+                handler( payload )
             else:
-                print( 'Unknown command: [{0}]'.format( text ) )
+                logger.warning( 'Unknown command: [%s]', text )
+            return
+
+        # check for trigger when alarm in one of specific statuses, any other status has nothing to do
+        status = self.status.main
+        if( status not in MqttAlarm.WATCHING_STATES ):
+            return
+        if( status in MqttAlarm.ARMED_STATES ):
+            #a single C level startswith rejects most topics that no trigger is interested in
+            if( not message.topic.startswith( self.triggerPrefixes ) ):
+                return
+            for t in self.__matchingTriggers( message.topic ):
+                if( t.matches( text ) ):
+                    self.__logTrigger( message.topic, text )
+                    self.__trigger( message.topic, text, t.notify )
         else:
-            # check for trigger when alarm in one of specific statuses
-            if( self.status.main in [ StatusMain.ARMED_AWAY, StatusMain.ARMED_HOME ] ):
-                triggers = []
-                if( StatusMain.ARMED_AWAY == self.armStatus ):
-                    triggers = self.armedAway.triggers
-                elif( StatusMain.ARMED_HOME == self.armStatus ):
-                    triggers = self.armedHome.triggers
-                for t in triggers:
-                    for o in t.topics: 
-                        if( mqtt.topic_matches_sub( o, message.topic ) and re.search( t.regex, text ) is not None ):
-                            self.__logTrigger( message )
-                            self.__trigger( message, t.notify )                            
-            elif( self.status.main in [ StatusMain.ACTIVATED, StatusMain.TRIGGERED ] ):
-                #when already activated or triggered just log the trigger event
-                self.__logTrigger( message )
-
-    def __logActivation( self, message ):
-        print( 'Alarm was ACTIVATED at [{}] by message <{}> "{}"'.format( datetime.now(), message.topic, message.payload.decode( "utf-8" ) ) )
+            #when already activated or triggered just log the trigger event
+            self.__logTrigger( message.topic, text )
+
+    def __parsePayload( self, text ):
+        """ Returns the json object in text as a dict, or None if text is not a json object.
+            Parsed once per command message and handed to the command handlers
+        """
+        if( not text.lstrip().startswith( '{' ) ):
+            return None
+        try:
+            return json.loads( text )
+        except ( ValueError, RuntimeError ):  # RuntimeError: nested too deep for the recursive decoder
+            return None
+
+    def __commandHandler( self, text, payload ):
+        """ Returns the handler of the command or None. For a json payload with a string "cmd" member this is a
+            single dict lookup, any other payload is searched for a command word with commandRegex
+        """
+        if( payload is not None ):
+            cmd = payload.get( 'cmd' )
+            #a list or object "cmd" is not hashable, and an exception here would end the network loop
+            handler = self.commandHandlers.get( cmd ) if isinstance( cmd, basestring ) else None
+            if( handler is not None ):
+                return handler
+        command = self.commandRegex.search( text )
+        return None if command is None else self.commandHandlers[ command.group( 1 ) ]
+
+    def __isCommandTopic( self, topic ):
+        """ topic_matches_sub against subscribeTopic, cached per topic since subscribeTopic never changes.
+            Once 500 topics are cached the oldest one is dropped for each new one
+        """
+        isCommand = self.commandTopics.get( topic )
+        if( isCommand is None ):
+            isCommand = mqtt.topic_matches_sub( self.mqttParams.subscribeTopic, topic )
+            self.commandTopics[ topic ] = isCommand
+            if( len( self.commandTopics ) > 500 ):
+                self.commandTopics.popitem( last = False )
+        return isCommand
+
+    def __matchingTriggers( self, topic ):
+        """ Returns the armed triggers subscribed to topic, in configuration order and without duplicates
+        """
+        matched = dict( self.triggerTrie.match( topic ) )
+        return [ matched[i] for i in sorted( matched ) ]
+
+    def __logActivation( self, topic, text ):
+        logger.warning( 'Alarm was ACTIVATED at [%s] by message <%s> "%s"', datetime.now(), topic, text )
     
-    def __activate( self, message, notify ):
-        self.__logActivation( message )
+    def __activate( self, topic, text, notify ):
+        self.__logActivation( topic, text )
         self.__setStatus( Status( StatusMain.ACTIVATED ) )
-        self.client.publish( self.notification.notifierMqttPublish, notify.toMqttCommand( self.notification.generateMessage( message ) ), qos = 2, retain = True )
+        #generating the message may wait on the translation service, so notify from a separate thread
+        #and leave the mqtt network loop free to keep processing messages
+        notifier = threading.Thread( target = self.__notify, args = ( topic, text, notify ) )
+        notifier.daemon = True
+        notifier.start()
+
+    def __notify( self, topic, text, notify ):
+        self.client.publish( self.notification.notifierMqttPublish, notify.toMqttCommand( self.notification.generateMessage( topic, text ) ), qos = 2, retain = True )
 
-    def __logTrigger( self, message ):
-        print( 'Alarm was triggered at [{}] by message <{}> "{}"'.format( datetime.now(), message.topic, message.payload.decode( "utf-8" ) ) )
+    def __logTrigger( self, topic, text ):
+        logger.warning( 'Alarm was triggered at [%s] by message <%s> "%s"', datetime.now(), topic, text )
 
-    def __trigger( self, message, notify ):
-        if( self.status.main not in [ StatusMain.ARMED_AWAY, StatusMain.ARMED_HOME ] ):
+    def __trigger( self, topic, text, notify ):
+        if( self.status.main not in MqttAlarm.ARMED_STATES ):
             return
-        print( 'Triggered!' )
+        logger.debug( 'Triggered!' )
         self.__setStatus( Status( StatusMain.TRIGGERED, self.triggeredCountdown, self.sendPin ) )
-        self.__doTrigger( message, notify )
+        self.__startCountdown( self.__doTrigger, topic, text, notify )
 
-    def __doTrigger( self, message, notify ):
-        """Will activate when triggerCountdown is finished
+    def __doTrigger( self, topic, text, notify ):
+        """Will activate when triggerCountdown is finished.
+            Returns True while the countdown must go on
         """
-        if( StatusMain.TRIGGERED != self.status.main ):
-            print( '__trigger will stop here because status is {} instead of ACTIVATED. The alarm was probably deactivated'.format( self.status.main ) )
-            return
+        status = self.status    # a command on the network thread may replace self.status while this step runs
+        if( StatusMain.TRIGGERED != status.main ):
+            logger.info( '__trigger will stop here because status is %s instead of ACTIVATED. The alarm was probably deactivated', STATUS_NAMES[ status.main ] )
+            return False
         
-        if( self.status.countdown > 0 ):
-            threading.Timer(1.0, self.__doTrigger, [message, notify] ).start()
-            print( '__doTrigger countdown {} to get to TRIGGERED'.format( self.status.countdown ) )
-            self.__setStatus( Status( StatusMain.TRIGGERED, self.status.countdown -1, self.sendPin ) )
+        if( status.countdown > 0 ):
+            logger.debug( '__doTrigger countdown %s to get to TRIGGERED', status.countdown )
+            status.tick( status.countdown -1 )
+            if( self.status is status ):
+                self.__setStatus( status, transient = True )
+            return True
         else:
-            print( '__doTrigger will set alarm to ACTIVATED because countdown has finished' )
-            self.__activate( message, notify )
+            logger.info( '__doTrigger will set alarm to ACTIVATED because countdown has finished' )
+            self.__activate( topic, text, notify )
+            return False
+
+    def __startCountdown( self, step, *args ):
+        """ Calls step( *args ) now and then once per second from the countdown thread, for as long as it returns True.
+            A countdown that is already running is cancelled first
+        """
+        self.__cancelCountdown()
+        if( not step( *args ) ):
+            return
+        with self.countdownCondition:
+            self.countdownStep = ( step, args )
+            self.countdownDue = clock() + 1.0
+            self.countdownCondition.notify()
+
+    def __runCountdowns( self ):
+        """ Body of the countdown thread. Sleeps while there is no countdown, otherwise calls its step every second.
+            A step that is late by more than a second is followed by at most one catch-up step, so a clock jump
+            cannot run the rest of a countdown back to back
+        """
+        while( True ):
+            with self.countdownCondition:
+                now = clock()
+                while( self.countdownStep is None or now < self.countdownDue ):
+                    self.countdownCondition.wait( None if self.countdownStep is None else self.countdownDue - now )
+                    now = clock()
+                countdown = self.countdownStep
+                self.countdownDue = max( self.countdownDue + 1.0, now )
+            #the step publishes and may start or cancel a countdown, so it runs without holding the condition
+            try:
+                goOn = countdown[0]( *countdown[1] )
+            except Exception:
+                logger.exception( 'countdown step failed, stopping the countdown' )
+                goOn = False
+            if( not goOn ):
+                with self.countdownCondition:
+                    if( self.countdownStep is countdown ):
+                        self.countdownStep = None
+
+    def __cancelCountdown( self ):
+        with self.countdownCondition:
+            self.countdownStep = None
     
     def __arm( self, finalArmStatus ):
-        """ Sets the status to arming and calls __doArm with the finalStatus
+        """ Sets the status to arming and starts a countdown calling __doArm with the finalStatus
             to be set after countdown
         """
         if( StatusMain.UNARMED != self.status.main ):
             return
 
         self.__setStatus( Status( StatusMain.ARMING, self.armingCountdown ) );
-        self.__doArm( finalArmStatus )
+        self.__startCountdown( self.__doArm, finalArmStatus )
     
     def __doArm( self, finalArmStatus ):
-        """ Will check countdown. If not 0, decrement and reschedule execution.
-            Else set finalArmingStatus
+        """ Will check countdown. If not 0, decrement and return True so that the countdown goes on.
+            Else set finalArmingStatus and return False
         """
-        if( StatusMain.ARMING != self.status.main ):
-            print( '__doArm will stop here because status is {} instead of ARMING'.format( self.status.main ) )
-            return
-
-        if( self.status.countdown > 0 ):
-            threading.Timer(1.0, self.__doArm, [ finalArmStatus ] ).start()
-            print( '__doArm countdown {} to get to {}'.format( self.status.countdown, finalArmStatus.main ) )
-            self.__setStatus( Status( StatusMain.ARMING, self.status.countdown -1 ) )
+        status = self.status    # a command on the network thread may replace self.status while this step runs
+        if( StatusMain.ARMING != status.main ):
+            logger.info( '__doArm will stop here because status is %s instead of ARMING', STATUS_NAMES[ status.main ] )
+            return False
+
+        if( status.countdown > 0 ):
+            logger.debug( '__doArm countdown %s to get to %s', status.countdown, STATUS_NAMES[ finalArmStatus.main ] )
+            status.tick( status.countdown -1 )
+            if( self.status is status ):
+                self.__setStatus( status, transient = True )
+            return True
         else:
-            print( '__doArm will set status to {} because countdown has finished'.format( finalArmStatus.main ) )
+            logger.info( '__doArm will set status to %s because countdown has finished', STATUS_NAMES[ finalArmStatus.main ] )
 
             #subscribe to trigger topics
-            triggers = []
-            mqttPublish = []
             if( StatusMain.ARMED_AWAY == finalArmStatus.main ):
-                triggers = self.armedAway.triggers
-                mqttPublish = self.armedAway.start
+                self.armConfig = self.armedAway
             elif( StatusMain.ARMED_HOME == finalArmStatus.main ):
-                triggers = self.armedHome.triggers
-                mqttPublish = self.armedHome.start
-            for t in triggers:
+                self.armConfig = self.armedHome
+            self.triggerTrie = TopicTrie()
+            for i, t in enumerate( self.armConfig.triggers ):
                 for o in t.topics:                    
-                    print( '\tsubscribing to trigger topic: {}', o )
-                    self.client.subscribe( o )  #subscribe to trigger topics
-            for p in mqttPublish:
+                    self.triggerTrie.insert( o, ( i, t ) )
+            topics = self.armConfig.triggerTopics()
+            #without the trailing '/', since 'a/#' also matches the parent topic 'a'
+            self.triggerPrefixes = tuple( set( o.split( '+', 1 )[0].split( '#', 1 )[0].rstrip( '/' ) for o in topics ) )
+            if( topics ):
+                logger.info( 'subscribing to trigger topics: %s', topics )
+                self.client.subscribe( [ ( o, 0 ) for o in topics ] )   #one SUBSCRIBE packet for all trigger topics
+            for p in self.armConfig.start:
                 self.client.publish( p.topic, p.command, qos = 2, retain = True )
 
             # set and publish new status
             self.armStatus = finalArmStatus.main
             self.__setStatus( finalArmStatus ) 
+            return False
 
     def __deactivateRequest( self ):
-        """ Generates a random pin and expects the mod 10 sum (per digit) with the disarmPin. When the answer comes will do the subtraction mod 10 and check against disarmPin
+        """ Generates a random pin and expects the mod 10 sum (per digit) with the disarmPin. The expected answer is computed here
+            once, so that checking the answer when it comes is a single comparison
         """
-        self.sendPin = ''
-        for i in range( 4 ):
-            self.sendPin += str( random.randint( 0, 9 ) )
-        print( 'disarmPin: {}, challengePin:{}'.format( self.disarmPin, self.sendPin ) )
+        self.sendPin = '{:04d}'.format( self.pinRandom.randrange( 10000 ) )
+        self.modPin = ''.join( str( ( int( s ) + d )%10 ) for s, d in zip( self.sendPin, self.disarmPinDigits ) )
+        logger.debug( 'disarmPin: %s, challengePin:%s', self.disarmPin, self.sendPin )
         self.__setStatus( Status( self.status.main, self.status.countdown, self.sendPin ) )
 
-    def __deactivate( self, text ):
-        print( 'Attempt to deactivate with text: "{}"'.format( text ) )
-        if( self.status.main not in [ StatusMain.TRIGGERED, StatusMain.ACTIVATED ] ):
-            print( 'Current status {}. Will not attempt deactivation.'.format( self.status.main.name ) )
+    def __deactivate( self, payload ):
+        """ payload is the command message already parsed by __parsePayload, None if it was not a json object
+        """
+        logger.info( 'Attempt to deactivate' )
+        logger.debug( 'deactivate payload: %s', payload )
+        if( self.status.main not in MqttAlarm.TRIGGERED_STATES ):
+            logger.info( 'Current status %s. Will not attempt deactivation.', STATUS_NAMES[ self.status.main ] )
             return
             
-        response = None
-        try:
-            response = json.loads( text )
-        except ValueError, e:
-            print( '"{}" is not a valid json text, exiting.'.format( text ) )
+        if( payload is None ):
+            logger.warning( 'The deactivate command is not a valid json object, exiting.' )
             return
         
-        if( 'pin' not in response ):
-            print( 'pin not found in text {}. Will not deactivate'.format( text ) )
+        if( 'pin' not in payload ):
+            logger.warning( 'pin not found in payload %s. Will not deactivate', payload )
+            return
+        pin = payload['pin']
+        if( not isinstance( pin, basestring ) ):
+            logger.warning( 'pin is a %s instead of a string, deactivate exits', type( pin ).__name__ )
+            return
+        if( len( pin ) < 4 or not pin[:4].isdigit() ):
+            logger.warning( 'pin does not start with 4 digits, deactivate exits' )
             return
-        pin = response['pin']
-        for i in range( 4 ):            
-            if( not pin[i].isdigit() ):
-                print( '{} is not a digit, deactivate exits'.format( text[i] ) )
-                return
 
-            if( str( ( int( pin[i] ) - int( self.sendPin[i] ) )%10 ) != self.disarmPin[i] ):
-                print( 'Wrong pin! Will not deactivate' )
-                return
+        #compare all the digits at once and in constant time, so that the time taken does not reveal how many digits were right
+        #non ascii digits become '?' and simply do not match
+        if( not hmac.compare_digest( pin[:4].encode( 'ascii', 'replace' ), self.modPin.encode( 'ascii' ) ) ):
+            logger.warning( 'Wrong pin! Will not deactivate' )
+            return
             
-        print( 'pin:{} == disarmPin:{}. Will deactivate '.format( text, self.disarmPin ) )
+        logger.info( 'Correct pin. Will deactivate' )
         self.sendPin = ''
+        self.modPin = ''
         self.__doDisarm()
 
     def __disarm( self ):
-        if( StatusMain.ARMED_AWAY == self.status.main or StatusMain.ARMED_HOME == self.status.main or StatusMain.ARMING == self.status.main ):
+        if( self.status.main in MqttAlarm.DISARMABLE_STATES ):
             self.__doDisarm()
 
     def __doDisarm( self ):
-            print( 'Disarm will unsubscribe from trigger topics' )
-            triggers = []
-            mqttPublish = []
-            if( StatusMain.ARMED_AWAY == self.status.main ):
-                triggers = self.armedAway.triggers
-                mqttPublish = self.armedAway.stop
-            elif( StatusMain.ARMED_HOME == self.status.main ):
-                triggers = self.armedHome.triggers
-                mqttPublish = self.armedHome.stop
-            for t in triggers:
-                for o in t.topics:                    
-                    print( '\tunsubscribing from trigger topic: {}', o )
-                    self.client.unsubscribe( o )
-            for p in mqttPublish:
-                self.client.publish( p.topic, p.command, qos = 2, retain = True )
-
+            self.__cancelCountdown()
+            logger.info( 'Disarm will unsubscribe from trigger topics' )
+            #armConfig is still set when disarming from TRIGGERED or ACTIVATED, not only from ARMED_*
+            if( self.armConfig is not None ):
+                topics = self.armConfig.triggerTopics()
+                if( topics ):
+                    logger.info( 'unsubscribing from trigger topics: %s', topics )
+                    self.client.unsubscribe( topics )   #one UNSUBSCRIBE packet for all trigger topics
+                for p in self.armConfig.stop:
+                    self.client.publish( p.topic, p.command, qos = 2, retain = True )
+            self.triggerTrie = TopicTrie()
+            self.triggerPrefixes = ()
+
+            self.armConfig = None
             self.armStatus = StatusMain.UNARMED
             self.__setStatus( Status( StatusMain.UNARMED ) )
 
-    def __setStatus( self, status ):
+    def __setStatus( self, status, transient = False ):
+        """ Sets the status and publishes it unless it equals the last retained status publish.
+            transient is for the intermediate seconds of a countdown: only every countdownPublishInterval-th second, or none if it is 0,
+            is published and with qos 1 and no retain, leaving the 4-packet qos 2 exchange and the broker's retained
+            message store to the actual state transitions
+        """
         self.status = status
-        self.client.publish( self.mqttParams.publishTopic, self.status.toJson(), qos = 2, retain = True )
+        payload = status.toJson()
+        if( payload == self.lastPublished ):
+            return
+        if( transient and ( 0 == self.countdownPublishInterval or status.countdown % self.countdownPublishInterval != 0 ) ):
+            return
+        self.lastPublished = None if transient else payload  # only a retained publish can make a later one redundant
+        self.client.publish( self.mqttParams.publishTopic, payload, qos = 1 if transient else 2, retain = not transient )
 
 if( __name__ == '__main__' ):
+    logging.basicConfig( level = logging.INFO, format = '%(asctime)s %(levelname)s %(message)s' )
     configurationFile = 'alarm.conf'
     if( not os.path.isfile( configurationFile ) ):
-        print( 'Configuration file "{}" not found, exiting.'.format( configurationFile ) )
+        logger.error( 'Configuration file "%s" not found, exiting.', configurationFile )
         sys.exit()
 
     with open( configurationFile ) as json_file:
         configuration = json.load( json_file )
-        print( 'Configuration: ' )
-        pprint( configuration )
+        logger.info( 'Configuration:\n%s', pformat( configuration ) )
 
         alarm = MqttAlarm( 
             configuration['armingCountdown'], 
@@ -417,41 +730,10 @@ if( __name__ == '__main__' ):
             configuration['disarmPin'], 
             configuration['mqttId'], 
             MqttParams( configuration['mqttParams']['address'], int( configuration['mqttParams']['port'] ), configuration['mqttParams']['subscribeTopic'], configuration['mqttParams']['publishTopic'] ),
-            ArmConfig( 
-                [ MqttPublish( x['topic'], x['command'] ) for x in configuration['armedAway']['start'] ],
-                [ MqttPublish( x['topic'], x['command'] ) for x in configuration['armedAway']['stop'] ],
-                [ 
-                    Trigger( 
-                        x['topics'], 
-                        x['regex'], 
-                        None if 'notify' not in x else Notify( 
-                            [] if 'sms' not in x['notify'] else x['notify']['sms'], 
-                            [] if 'phonecall' not in x['notify'] else x['notify']['phonecall'], 
-                            [] if 'im' not in x['notify'] else x['notify']['im'], 
-                            None if 'email' not in x['notify'] else EmailConfig( x['notify']['email']['from'], x['notify']['email']['to'], x['notify']['email']['subject']  )
-                        )
-                    )
-                    for x in configuration['armedAway']['triggers']
-                ]
-            ),
-            ArmConfig( 
-                [ MqttPublish( x['topic'], x['command'] ) for x in configuration['armedHome']['start'] ],
-                [ MqttPublish( x['topic'], x['command'] ) for x in configuration['armedHome']['stop'] ],
-                [ 
-                    Trigger( 
-                        x['topics'], 
-                        x['regex'], 
-                        None if 'notify' not in x else Notify( 
-                            [] if 'sms' not in x['notify'] else x['notify']['sms'], 
-                            [] if 'phonecall' not in x['notify'] else x['notify']['phonecall'], 
-                            [] if 'im' not in x['notify'] else x['notify']['im'], 
-                            None if 'email' not in x['notify'] else EmailConfig( x['notify']['email']['from'], x['notify']['email']['to'], x['notify']['email']['subject']  )
-                        )
-                    )
-                    for x in configuration['armedHome']['triggers'] 
-                ]
-            ),
-            Notification( configuration['notification']['notifierMqttPublish'], configuration['notification']['messageTemplate'], configuration['notification']['translationUrl'] ),
-            Status( StatusMain[ configuration['status']['main'] ], configuration['status']['countdown'] )
+            ArmConfig.fromConfiguration( configuration['armedAway'] ),
+            ArmConfig.fromConfiguration( configuration['armedHome'] ),
+            Notification( configuration['notification']['notifierMqttPublish'], configuration['notification']['messageTemplate'], configuration['notification']['translationUrl'], configuration['notification'].get( 'translationCacheTtl', 3600 ) ),
+            Status( StatusMain[ configuration['status']['main'] ], configuration['status']['countdown'] ),
+            configuration.get( 'countdownPublishInterval', 1 )
         )
         alarm.run()
\ No newline at end of file